@@ -1,5 +1,6 @@
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
 import json
 import yaml
@@ -10,6 +11,23 @@ from datetime import date, timedelta, datetime
 import pyodbc
 from math import ceil
 from time import sleep
+import os
+import gzip
+import zlib
+import hashlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections import OrderedDict
+import asyncio
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 
 def logs(message, logtype='info'):
@@ -70,6 +88,7 @@ def execute_query(select=False, **kwargs):
     query = kwargs.get('query', '')
 
     res = []
+    ok = True
 
     if not ms_sql_db or not ms_sql_db_host or not ms_sql_db_user or not ms_sql_db_pass or not query:
         logs('Not enough parameters for query', 'error')
@@ -93,11 +112,13 @@ def execute_query(select=False, **kwargs):
         cnxn.commit()
     except Exception as E:
         logs(f'Error {E} in query {query}', 'error')
+        ok = False
     finally:
         cnxn.close()
 
     if select:
         return res
+    return ok
 
 
 def get_types():
@@ -155,16 +176,25 @@ def get_create_table_query(name, orginalname, metadata, indexes=None):
     return querytext
 
 
-def checktable(name, orginalname, metadata, **kwargs):
+def get_table_columns(name, **kwargs):
     query = f"SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE table_name = '{name}'"
     cols_rows = execute_query(select=True, query=query, **kwargs)
     cols_sql = set()
     for each in cols_rows:
         cols_sql.add(each[0])
+    return cols_sql
+
+
+def get_missing_fields(name, orginalname, metadata, **kwargs):
+    cols_sql = get_table_columns(name, **kwargs)
     cols_meta = set()
     for each in metadata[orginalname]:
         cols_meta.add(each)
-    add_fields = cols_meta - cols_sql
+    return cols_meta - cols_sql
+
+
+def checktable(name, orginalname, metadata, **kwargs):
+    add_fields = get_missing_fields(name, orginalname, metadata, **kwargs)
     if len(add_fields) != 0:
         query = f'DROP TABLE [dbo].[{name}]'
         execute_query(query=query, **kwargs)
@@ -190,6 +220,53 @@ def deleterows(**kwargs):
             return f"DELETE FROM [dbo].[{table}] WHERE [{date_field}] BETWEEN '{date_from}T00:00:00' and '{date_to}T23:59:59';"
 
 
+def get_create_hash_table_query(hash_table):
+    querytext = f"IF NOT EXISTS \n(SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = N'{hash_table}') \nBEGIN\n"
+    querytext += f"CREATE TABLE [dbo].[{hash_table}]("
+    querytext += "\n[table_name] nvarchar(256) NOT NULL,"
+    querytext += "\n[date_from] nvarchar(32) NOT NULL,"
+    querytext += "\n[date_to] nvarchar(32) NOT NULL,"
+    querytext += "\n[payload_hash] nvarchar(64) NOT NULL"
+    querytext += ") ON [PRIMARY];"
+    querytext += '\nEND;'
+    return querytext
+
+
+def get_hashes(hash_table, table, **kwargs):
+    # stored hashes of responses for table periods: {(date_from, date_to): hash}
+    query = f"SELECT [date_from], [date_to], [payload_hash] FROM [dbo].[{hash_table}] WHERE [table_name] = N'{table}'"
+    rows = execute_query(select=True, query=query, **kwargs)
+    hashes = dict()
+    for each in rows or []:
+        hashes[(each[0], each[1])] = each[2]
+    return hashes
+
+
+def get_delete_hash_query(hash_table, table, period):
+    return f"DELETE FROM [dbo].[{hash_table}] WHERE [table_name] = N'{table}' " \
+           f"and [date_from] = N'{period[0]}' and [date_to] = N'{period[1]}';"
+
+
+def get_save_hash_query(hash_table, table, period, payload_hash):
+    querytext = get_delete_hash_query(hash_table, table, period)
+    querytext += f"\nINSERT INTO [dbo].[{hash_table}] ([table_name], [date_from], [date_to], [payload_hash]) " \
+                 f"VALUES (N'{table}', N'{period[0]}', N'{period[1]}', N'{payload_hash}');"
+    return querytext
+
+
+def get_clear_hashes_query(hash_table, table):
+    return f"DELETE FROM [dbo].[{hash_table}] WHERE [table_name] = N'{table}';"
+
+
+def get_payload_hash(request_url, json_text):
+    # records are sorted so the hash does not depend on order of records in response
+    records = json_text.get('value', None) or []
+    normalized = [json.dumps(record, sort_keys=True, ensure_ascii=False, default=str) for record in records]
+    normalized.sort()
+    normalized.insert(0, request_url)
+    return hashlib.sha256('\n'.join(normalized).encode('UTF-8')).hexdigest()
+
+
 def get_insert_table_queries(name, json_text):
     portion = 1000
     records = json_text.get('value', None)
@@ -249,6 +326,209 @@ def get_insert_table_queries(name, json_text):
 # ====================== SQL write ======================
 
 
+# ===================== Response archive START =====================
+def get_archive(global_config):
+    archive_dir = str(global_config.get('archive_dir', '') or '').strip()
+    if not archive_dir:
+        return None
+    archive = dict()
+    archive['dir'] = archive_dir
+    archive['compression'] = str(global_config.get('archive_compression', 'gzip')).strip().lower()
+    archive['max_bytes'] = int(float(global_config.get('archive_max_mb', 1024)) * 1024 * 1024)
+    archive['replay'] = bool(global_config.get('replay', False))
+    # configs for different services share archive_dir - files of each service are in own folder
+    base_url = str(global_config.get('base_url', '')).strip().rstrip('/')
+    archive['prefix'] = hashlib.sha1(base_url.encode('UTF-8')).hexdigest()[:10]
+    if archive['compression'] == 'zstd' and zstandard is None:
+        logs('zstandard is not installed - archive will use gzip', 'info')
+        archive['compression'] = 'gzip'
+    if not archive['replay']:
+        # archive is scanned once, then files and size are updated on write
+        archive['files'] = archive_scan(archive_dir)
+        archive['size'] = sum(archive['files'].values())
+    return archive
+
+
+def archive_scan(archive_dir):
+    # files of archive from oldest to newest with their sizes
+    files = []
+    for folder, _, filenames in os.walk(archive_dir):
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(folder, filename))
+            if filename.endswith('.tmp'):
+                # left by interrupted write
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, path, stat.st_size))
+    files.sort()
+    return OrderedDict((path, size) for _, path, size in files)
+
+
+def get_archive_key(archive, table, request_url, period=None, json_allowed=False):
+    # period - tuple of dates from generate_dates, None for full request
+    # hash of url separates data_request and full_data_request, json and xml
+    if json_allowed:
+        request_url = get_json_url(request_url)
+    url_hash = hashlib.sha1(request_url.encode('UTF-8')).hexdigest()[:8]
+    if not period:
+        return f'{archive["prefix"]}/{table}/full_{url_hash}'
+    return f'{archive["prefix"]}/{table}/{period[0][:10]}_{period[1][:10]}_{url_hash}'
+
+
+def archive_write(archive, key, text):
+    data = text.encode('UTF-8')
+    if archive['compression'] == 'zstd':
+        path = os.path.normpath(os.path.join(archive['dir'], key + '.zst'))
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        path = os.path.normpath(os.path.join(archive['dir'], key + '.gz'))
+        data = gzip.compress(data)
+    files = archive['files']
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # file appears under its name only when it is written completely
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+        # only one copy of response for key
+        for ext in ('.zst', '.gz'):
+            other = os.path.normpath(os.path.join(archive['dir'], key + ext))
+            if other != path and os.path.exists(other):
+                os.remove(other)
+                archive['size'] -= files.pop(other, 0)
+    except Exception as E:
+        logs(f'Error {E} writing archive {path}', 'error')
+        return
+    # the newest file goes to the end
+    archive['size'] -= files.pop(path, 0)
+    files[path] = len(data)
+    archive['size'] += len(data)
+    archive_evict(archive)
+
+
+def archive_read(archive, key):
+    for ext in ('.zst', '.gz'):
+        path = os.path.join(archive['dir'], key + ext)
+        if not os.path.exists(path):
+            continue
+        if ext == '.zst' and zstandard is None:
+            logs(f'zstandard is not installed - cannot read {path}', 'error')
+            return None
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            if ext == '.zst':
+                data = zstandard.ZstdDecompressor().decompress(data)
+            else:
+                data = gzip.decompress(data)
+            return data.decode('UTF-8')
+        except Exception as E:
+            logs(f'Error {E} reading archive {path}', 'error')
+            return None
+    return None
+
+
+def archive_evict(archive):
+    # remove oldest files while archive is bigger than max size, the newest file is kept
+    files = archive['files']
+    while archive['size'] > archive['max_bytes'] and len(files) > 1:
+        path, size = files.popitem(last=False)
+        archive['size'] -= size
+        try:
+            os.remove(path)
+        except OSError as E:
+            logs(f'Error {E} removing {path}', 'error')
+            continue
+        logs(f'   Archive: removed {path}', 'info')
+# =====================  Response archive END=====================
+
+
+# ===================== HTTP transport START =====================
+def add_traffic(wire, decoded):
+    global wire_bytes, decoded_bytes
+    with traffic_lock:
+        wire_bytes += wire
+        decoded_bytes += decoded
+
+
+def reset_traffic():
+    # traffic is reported for each yaml file
+    global wire_bytes, decoded_bytes
+    with traffic_lock:
+        wire_bytes = 0
+        decoded_bytes = 0
+
+
+def get_traffic_message():
+    return f'Traffic: {format_bytes(wire_bytes)} on the wire, {format_bytes(decoded_bytes)} decoded'
+
+
+def get_session(api_login, api_password, pool_size=10):
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(api_login, api_password)
+    # requests asks for gzip/deflate and keeps connections by default, pool is sized to parallel requests
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def http_get(session, url, request_timeout=60):
+    # body is read without decompression to count bytes from the wire (raw.tell() misses chunked bodies)
+    response = session.get(url, timeout=request_timeout, stream=True)
+    raw_content = b''.join(response.raw.stream(64 * 1024, decode_content=False))
+    content = decode_content(raw_content, response.headers.get('Content-Encoding'))
+    response._content = content
+    response._content_consumed = True
+    add_traffic(len(raw_content), len(content))
+    return response
+
+
+def decode_content(content, encoding):
+    # body of response read without decompression
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'gzip':
+        return gzip.decompress(content)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
+
+
+async def get_counts_async(urls, api_login, api_password, request_timeout=60, workers=4):
+    # $count for urls with asyncio, not more than workers requests at once
+    semaphore = asyncio.Semaphore(workers)
+    connector = aiohttp.TCPConnector(limit=workers)
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    auth = aiohttp.BasicAuth(api_login, api_password)
+    # only encodings decode_content can handle
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+
+    # body is decompressed here to count bytes read from the wire
+    async with aiohttp.ClientSession(auth=auth, connector=connector, timeout=timeout, headers=headers,
+                                     auto_decompress=False) as session:
+        async def get_count_async(url):
+            count_url = get_count_url(url)
+            async with semaphore:
+                try:
+                    async with session.get(count_url) as response:
+                        raw_content = await response.read()
+                        content = decode_content(raw_content, response.headers.get('Content-Encoding'))
+                        add_traffic(len(raw_content), len(content))
+                        if response.status == 200:
+                            return limit_count(int(content.decode('UTF-8').strip()), url)
+                        logs(f'Error {response.status} for {count_url}', 'info')
+                except Exception as E:
+                    logs(f'Error {E} for {count_url}', 'info')
+            return None
+
+        return await asyncio.gather(*[get_count_async(url) for url in urls])
+# =====================  HTTP transport END=====================
+
+
 def get_original_name_from_request(request):
     result = request
     if result:
@@ -258,12 +538,19 @@ def get_original_name_from_request(request):
     return result
 
 
-def get_metadata(session, base_url, request_timeout=60):
+def get_metadata(session, base_url, request_timeout=60, archive=None):
     metastructure = base_url + '$metadata'
-    response = session.get(metastructure, timeout=request_timeout)
-    if response.status_code == 200:
+    if archive and archive['replay']:
+        xml_text = archive_read(archive, archive['prefix'] + '/$metadata')
+    else:
+        xml_text = None
+        response = http_get(session, metastructure, request_timeout)
+        if response.status_code == 200:
+            xml_text = response.text
+            if archive:
+                archive_write(archive, archive['prefix'] + '/$metadata', xml_text)
+    if xml_text:
         metadata = dict()
-        xml_text = response.text
         root = ET.fromstring(xml_text)
         standart_Odata = root[0][0]
         for element in standart_Odata:
@@ -282,17 +569,64 @@ def get_metadata(session, base_url, request_timeout=60):
         return metadata
 
 
-def get_json(session, url, request_timeout=60):
-    jsonquery_filter = '?$format=json;odata=nometadata&'
-    if not jsonquery_filter in url:
-        url = url.replace('?', jsonquery_filter)
+def parse_json(json_text):
+    return json.loads(json_text)
+
+
+def parse_xml(xml_text):
+    res = list()
+    root = ET.fromstring(xml_text)
+    for element in root:
+        _rec = dict()
+        for sub in element:
+            if 'content' in sub.tag:
+                for field in sub[0]:
+                    _tag = field.tag.replace('{http://schemas.microsoft.com/ado/2007/08/dataservices}',
+                                             '')
+
+                    isNull = field.attrib.get(
+                        '{http://schemas.microsoft.com/ado/2007/08/dataservices/metadata}null', False)
+                    if (len(field.attrib) != 0) and not isNull:
+                        _val = list()
+                        for _table in field:
+                            _el = dict()
+                            for sub_el in _table:
+                                _el_tag = sub_el.tag.replace(
+                                    '{http://schemas.microsoft.com/ado/2007/08/dataservices}',
+                                    '')
+                                _el_val = sub_el.text
+                                _el[_el_tag] = _el_val
+                            _val.append(_el)
+                    else:
+                        _val = field.text
+                    _rec[_tag] = _val
+                res.append(_rec)
+    js = dict()
+    js['value'] = res
+    return js
+
+
+def get_parsed(session, url, parser, request_timeout=60, archive=None, archive_key=''):
+    # in replay mode raw response is taken from archive instead of OData
+    if archive and archive['replay']:
+        try:
+            raw_text = archive_read(archive, archive_key)
+            if raw_text is None:
+                logs(f'No archived response for {archive_key}', 'error')
+                return None
+            return parser(raw_text)
+        except Exception as E:
+            logs(f'Error {E} parsing archived response {archive_key}', 'error')
+            return None
 
     for _ in range(20):
         try:
-            response = session.get(url, timeout=request_timeout)
+            response = http_get(session, url, request_timeout)
             if response.status_code == 200:
-                json_text = response.text
-                root = json.loads(json_text)
+                raw_text = response.text
+                root = parser(raw_text)
+                if archive:
+                    archive_write(archive, archive_key, raw_text)
                 return root
         except Exception as E:
             logs(f'Connection error {E}- try {_}', 'info')
@@ -301,53 +635,284 @@ def get_json(session, url, request_timeout=60):
     return None
 
 
-def get_json_from_xml(session, url, request_timeout=60):
-    res = list()
+def get_json_url(url):
+    jsonquery_filter = '?$format=json;odata=nometadata&'
+    if not jsonquery_filter in url:
+        url = url.replace('?', jsonquery_filter)
+    return url
 
-    for _ in range(20):
-        try:
-            response = session.get(url, timeout=request_timeout)
-            if response.status_code == 200:
-                xml_text = response.text
-                root = ET.fromstring(xml_text)
-                for element in root:
-                    _rec = dict()
-                    for sub in element:
-                        if 'content' in sub.tag:
-                            for field in sub[0]:
-                                _tag = field.tag.replace('{http://schemas.microsoft.com/ado/2007/08/dataservices}',
-                                                         '')
-
-                                isNull = field.attrib.get(
-                                    '{http://schemas.microsoft.com/ado/2007/08/dataservices/metadata}null', False)
-                                if (len(field.attrib) != 0) and not isNull:
-                                    _val = list()
-                                    for _table in field:
-                                        _el = dict()
-                                        for sub_el in _table:
-                                            _el_tag = sub_el.tag.replace(
-                                                '{http://schemas.microsoft.com/ado/2007/08/dataservices}',
-                                                '')
-                                            _el_val = sub_el.text
-                                            _el[_el_tag] = _el_val
-                                        _val.append(_el)
-                                else:
-                                    _val = field.text
-                                _rec[_tag] = _val
-                            res.append(_rec)
-                js = dict()
-                js['value'] = res
-                return js
-        except Exception as E:
-            logs(f'Connection error {E}- try {_}', 'info')
-            sleep(60)
-    logs(f'Connection error - cannot get info for url {url}', 'error')
+
+def get_json(session, url, request_timeout=60, archive=None, archive_key=''):
+    url = get_json_url(url)
+
+    return get_parsed(session, url, parse_json, request_timeout, archive, archive_key)
+
+
+def get_json_from_xml(session, url, request_timeout=60, archive=None, archive_key=''):
+    return get_parsed(session, url, parse_xml, request_timeout, archive, archive_key)
+
+
+def get_table_requests(tabledict, base_url, checked):
+    # urls and periods to be requested for table
+    # full or period
+    date_mode = tabledict['date_mode']
+
+    if checked:
+        # all fine - just read data
+        json_url = base_url + tabledict["data_request"]
+    else:
+        # new table - use full data request
+        j_request = tabledict.get('full_data_request', tabledict["data_request"])
+        json_url = base_url + j_request
+        # set mode to full
+        date_mode = 'full'
+
+    date_field = tabledict.get('date_field', '')
+    date_from = ''
+    date_to = ''
+    requests_url = []
+    requests_periods = []
+    if not date_field:
+        # if we cannot use data field param - date mode is full
+        # and we use only ode request
+        date_mode = 'full'
+        requests_url.append(json_url)
+        requests_periods.append(None)
+    else:
+        startday_param = '#STARTDATE#'
+        finishday_param = '#FINISHDATE#'
+        date_inc = tabledict.get('date_inc', '1d')
+        if date_mode == 'period':
+            date_from = tabledict.get('date_from', str(date.today()))
+            date_to = tabledict.get('date_to', str(date.today()))
+        else:
+            date_from = tabledict.get('date_from_full', str(date.today()))
+            date_to = tabledict.get('date_to_full', str(date.today()))
+        periods = generate_dates(date_from, date_to, date_inc)
+        for period in periods:
+            request_url = json_url.replace(startday_param, period[0])
+            request_url = request_url.replace(finishday_param, period[1])
+            requests_url.append(request_url)
+            requests_periods.append(period)
+
+    table_requests = dict()
+    table_requests['date_mode'] = date_mode
+    table_requests['date_field'] = date_field
+    table_requests['date_from'] = date_from
+    table_requests['date_to'] = date_to
+    table_requests['requests_url'] = requests_url
+    table_requests['requests_periods'] = requests_periods
+    return table_requests
+
+
+# ===================== Load plan START =====================
+def load_stats(stats_file):
+    # throughput of previous loads by table
+    if not os.path.exists(stats_file):
+        return dict()
+    try:
+        with open(stats_file, encoding='UTF-8') as file:
+            return json.load(file)
+    except Exception as E:
+        logs(f'Error {E} reading stats from {stats_file}', 'error')
+    return dict()
+
+
+def save_stats(stats_file, stats):
+    try:
+        with open(stats_file, 'w', encoding='UTF-8') as file:
+            json.dump(stats, file, ensure_ascii=False, indent=2)
+    except Exception as E:
+        logs(f'Error {E} writing stats to {stats_file}', 'error')
+
+
+def get_count_url(request_url):
+    # Table?$filter=...&$select=... -> Table/$count?$filter=...
+    position = request_url.find('?')
+    if position == -1:
+        return request_url + '/$count'
+    params = [param for param in request_url[position + 1:].split('&') if param.startswith('$filter=')]
+    count_url = request_url[:position] + '/$count'
+    if params:
+        count_url += '?' + '&'.join(params)
+    return count_url
+
+
+def limit_count(count, request_url):
+    # $count is sent with $filter only, $skip and $top of request are applied here
+    position = request_url.find('?')
+    if position == -1:
+        return count
+    params = dict()
+    for param in request_url[position + 1:].split('&'):
+        name, _, value = param.partition('=')
+        params[name] = value.strip()
+    if params.get('$skip', '').isdigit():
+        count = max(0, count - int(params['$skip']))
+    if params.get('$top', '').isdigit():
+        count = min(count, int(params['$top']))
+    return count
+
+
+def get_count(session, url, request_timeout=60):
+    count_url = get_count_url(url)
+    try:
+        response = http_get(session, count_url, request_timeout)
+        if response.status_code == 200:
+            return limit_count(int(response.text.strip()), url)
+        logs(f'Error {response.status_code} for {count_url}', 'info')
+    except Exception as E:
+        logs(f'Error {E} for {count_url}', 'info')
     return None
 
 
+def get_archived_count(archive, key, json_allowed):
+    # number of rows in archived response instead of $count in replay mode
+    raw_text = archive_read(archive, key)
+    if raw_text is None:
+        logs(f'No archived response for {key}', 'info')
+        return None
+    try:
+        json_text = parse_json(raw_text) if json_allowed else parse_xml(raw_text)
+    except Exception as E:
+        logs(f'Error {E} parsing archived response {key}', 'info')
+        return None
+    return len(json_text.get('value', None) or [])
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+def plan_line(message):
+    # plan is printed always, not only in verbose mode
+    logging.info(message)
+    print(message)
+
+
+def plan(yaml_file):
+    logs(f'Plan for {yaml_file}', 'info')
+    reset_traffic()
+    with open(yaml_file, encoding='UTF-8') as file:
+        settings = yaml.load(file, Loader=yaml.FullLoader)
+    if not settings:
+        logs(f'Error loading settings from {yaml_file}', 'error')
+        return
+
+    global_config = settings['global_config']
+    base_url = str(global_config['base_url']).strip()
+    if base_url[:-1] != '/':
+        base_url += '/'
+    request_timeout = int(global_config.get('request_timeout', 60))
+    skip_unchanged = bool(global_config.get('skip_unchanged', False))
+    json_allowed = bool(global_config.get('json_allowed', False))
+    plan_workers = int(global_config.get('plan_workers', 4))
+    http_backend = str(global_config.get('http_backend', 'requests')).strip().lower()
+    if http_backend == 'async' and aiohttp is None:
+        logs('aiohttp is not installed - requests will be used', 'info')
+        http_backend = 'requests'
+    stats = load_stats(str(global_config.get('stats_file', 'odata_stats.json')).strip())
+
+    # archive is used only for reading in replay mode, plan writes nothing
+    # and in replay rows are counted in archived responses without requests to OData
+    # (get_archive does not scan archive folder in replay)
+    archive = None
+    if global_config.get('replay', False):
+        archive = get_archive(global_config)
+
+    api_login = str(global_config['api_login']).strip()
+    api_password = str(global_config['api_pwd']).strip()
+    session = get_session(api_login, api_password, plan_workers)
+
+    metadata = get_metadata(session, base_url, request_timeout, archive)
+    if not metadata:
+        logs(f'Cannot get metadata for {base_url}', 'error')
+        session.close()
+        return
+    tables = settings['tables']
+
+    plan_line(f'Plan for {yaml_file}')
+    plan_line(f'{"table":<40} {"mode":<6} {"requests":>8} {"rows":>10} {"bytes":>10} {"time":>9}  SQL actions')
+    total_requests = 0
+    total_rows = 0
+    total_bytes = 0
+    total_seconds = 0
+    for table in tables:
+        tabledict = tables[table]
+        original_table = get_original_name_from_request(tabledict['data_request'])
+        if not original_table or original_table not in metadata:
+            logs(f'No table for "{tabledict["data_request"]}"', 'info')
+            continue
+
+        # the same checks as in run, but only with select queries
+        actions = []
+        checked = True
+        cols_sql = get_table_columns(table, **global_config)
+        if not cols_sql:
+            actions.append('create')
+        elif get_missing_fields(table, original_table, metadata, **global_config):
+            actions.append('drop and create')
+            checked = False
+
+        table_requests = get_table_requests(tabledict, base_url, checked)
+        date_mode = table_requests['date_mode']
+        requests_url = table_requests['requests_url']
+        if date_mode != 'period':
+            actions.append('truncate')
+        elif skip_unchanged:
+            actions.append(f'delete changed periods {table_requests["date_from"]} - {table_requests["date_to"]}')
+        else:
+            actions.append(f'delete {table_requests["date_from"]} - {table_requests["date_to"]}')
+
+        # rows for each request: from archive in replay, else $count, not more than plan_workers at once
+        if archive:
+            counts = [get_archived_count(archive, get_archive_key(archive, table, url, period, json_allowed),
+                                         json_allowed)
+                      for url, period in zip(requests_url, table_requests['requests_periods'])]
+        elif http_backend == 'async':
+            counts = asyncio.run(get_counts_async(requests_url, api_login, api_password, request_timeout,
+                                                  plan_workers))
+        else:
+            with ThreadPoolExecutor(max_workers=plan_workers) as executor:
+                counts = list(executor.map(lambda url: get_count(session, url, request_timeout), requests_url))
+        rows_known = None not in counts
+        rows = sum(count for count in counts if count is not None)
+
+        # estimates by throughput of previous load
+        table_stats = stats.get(table, dict())
+        est_bytes = None
+        est_seconds = None
+        if table_stats.get('rows'):
+            est_bytes = rows * table_stats['bytes'] / table_stats['rows']
+            est_seconds = rows * table_stats['seconds'] / table_stats['rows']
+        elif table_stats.get('requests'):
+            est_seconds = len(requests_url) * table_stats['seconds'] / table_stats['requests']
+
+        total_requests += len(requests_url)
+        total_rows += rows
+        total_bytes += est_bytes or 0
+        total_seconds += est_seconds or 0
+
+        rows_text = str(rows) if rows_known else f'{rows}+'
+        bytes_text = format_bytes(est_bytes) if est_bytes is not None else '?'
+        time_text = str(timedelta(seconds=int(est_seconds))) if est_seconds is not None else '?'
+        plan_line(f'{table:<40} {date_mode:<6} {len(requests_url):>8} {rows_text:>10} {bytes_text:>10} {time_text:>9}  '
+                  + ', '.join(actions))
+    plan_line(f'{"total":<40} {"":<6} {total_requests:>8} {total_rows:>10} {format_bytes(total_bytes):>10} '
+              f'{str(timedelta(seconds=int(total_seconds))):>9}')
+    logs(get_traffic_message(), 'info')
+    session.close()
+# =====================  Load plan END=====================
+
+
 def run(yaml_file):
     global verbose
     logs(f'Starting with {yaml_file}', 'info')
+    reset_traffic()
     with open(yaml_file, encoding='UTF-8') as file:
         settings = yaml.load(file, Loader=yaml.FullLoader)
     if not settings:
@@ -365,22 +930,37 @@ def run(yaml_file):
     json_allowed = bool(global_config.get('json_allowed', False))
     request_timeout = int(global_config.get('request_timeout', 60))
 
+    # skip periods with the same response as in previous load
+    skip_unchanged = bool(global_config.get('skip_unchanged', False))
+    hash_table = str(global_config.get('hash_table', 'OdataPayloadHashes')).strip()
+
+    # throughput of load for plan
+    stats_file = str(global_config.get('stats_file', 'odata_stats.json')).strip()
+    stats = load_stats(stats_file)
+
     if log_mode == "verbose":
         verbose = True
 
+    # archive of raw responses, in replay mode OData is not requested
+    archive = get_archive(global_config)
+    if archive and archive['replay']:
+        logs(f'Replay from archive {archive["dir"]}', 'info')
+
     # create session for HTTP-requests
     api_login = str(global_config['api_login']).strip()
     api_password = str(global_config['api_pwd']).strip()
 
-    auth = HTTPBasicAuth(api_login, api_password)
-    session = requests.Session()
-    session.auth = auth
+    session = get_session(api_login, api_password)
 
     # getting metadata for service
-    metadata = get_metadata(session, base_url, request_timeout)
+    metadata = get_metadata(session, base_url, request_timeout, archive)
     tables = settings['tables']
     logs(f'found tables: {len(tables)}', 'info')
 
+    if skip_unchanged:
+        query = get_create_hash_table_query(hash_table)
+        execute_query(**global_config, query=query)
+
     # working with OData tables in yaml
     for table in tables:
         tabledict = tables[table]
@@ -390,6 +970,22 @@ def run(yaml_file):
             continue
         logs(f'Working with {table}', 'info')
 
+        created = not get_table_columns(table, **global_config)
+
+        if archive and archive['replay']:
+            # rows are deleted only when all responses for table are in archive and can be read
+            will_check = created or not get_missing_fields(table, original_table, metadata, **global_config)
+            table_requests = get_table_requests(tabledict, base_url, will_check)
+            missing_keys = []
+            for request_url, period in zip(table_requests['requests_url'], table_requests['requests_periods']):
+                request_key = get_archive_key(archive, table, request_url, period, json_allowed)
+                if archive_read(archive, request_key) is None:
+                    missing_keys.append(request_key)
+            if missing_keys:
+                logs(f'No readable archived responses for {table}: {len(missing_keys)} of '
+                     f'{len(table_requests["requests_url"])}, first {missing_keys[0]} - table skipped', 'error')
+                continue
+
         # create new table or check if it exists
         query = get_create_table_query(table, original_table, metadata)
         execute_query(**global_config, query=query)
@@ -399,64 +995,76 @@ def run(yaml_file):
         # if smth wrong - create table from scratch
         checked = checktable(table, original_table, metadata, **global_config)
 
-        # full or period
-        date_mode = tabledict['date_mode']
+        if skip_unchanged and (created or not checked):
+            # stored hashes are not valid for new empty table
+            execute_query(**global_config, query=get_clear_hashes_query(hash_table, table))
 
-        if checked:
-            # all fine - just read data
-            json_url = base_url + tabledict["data_request"]
-        else:
-            # new table - use full data request
-            j_request = tabledict.get('full_data_request', tabledict["data_request"])
-            json_url = base_url + j_request
-            # set mode to full
-            date_mode = 'full'
-
-        date_field = tabledict.get('date_field', '')
-        requests_url = []
-        if not date_field:
-            # if we cannot use data field param - date mode is full
-            # and we use only ode request
-            date_mode = 'full'
-            requests_url.append(json_url)
-        else:
-            startday_param = '#STARTDATE#'
-            finishday_param = '#FINISHDATE#'
-            date_inc = tabledict.get('date_inc', '1d')
-            if date_mode == 'period':
-                date_from = tabledict.get('date_from', str(date.today()))
-                date_to = tabledict.get('date_to', str(date.today()))
-            else:
-                date_from = tabledict.get('date_from_full', str(date.today()))
-                date_to = tabledict.get('date_to_full', str(date.today()))
-            periods = generate_dates(date_from, date_to, date_inc)
-            for period in periods:
-                request_url = json_url.replace(startday_param, period[0])
-                request_url = request_url.replace(finishday_param, period[1])
-                requests_url.append(request_url)
+        table_requests = get_table_requests(tabledict, base_url, checked)
+        date_mode = table_requests['date_mode']
+        date_field = table_requests['date_field']
+        date_from = table_requests['date_from']
+        date_to = table_requests['date_to']
+        requests_url = table_requests['requests_url']
+        requests_periods = table_requests['requests_periods']
+
+        # with skip_unchanged rows are deleted for each changed period separately
+        by_period = skip_unchanged and date_mode == 'period'
+        hashes = dict()
 
         # clean table
-        if date_mode == 'period':
-            del_query = deleterows(table_name=table, date_field=date_field, date_from=str_to_date(date_from),
-                                   date_to=str_to_date(date_to), all=False)
+        if by_period:
+            # replay is a reload on purpose - periods are rewritten even if not changed
+            if not (archive and archive['replay']):
+                hashes = get_hashes(hash_table, table, **global_config)
         else:
-            # truncate all records
-            del_query = deleterows(table_name=table, all=True)
-        execute_query(**global_config, query=del_query)
+            if date_mode == 'period':
+                del_query = deleterows(table_name=table, date_field=date_field, date_from=str_to_date(date_from),
+                                       date_to=str_to_date(date_to), all=False)
+            else:
+                # truncate all records
+                del_query = deleterows(table_name=table, all=True)
+            execute_query(**global_config, query=del_query)
+            if skip_unchanged:
+                # stored hashes are not valid after truncate or delete
+                execute_query(**global_config, query=get_clear_hashes_query(hash_table, table))
 
         logs(f'   Requests to be sent: {len(requests_url)}', 'info')
+        started = datetime.now()
+        started_bytes = decoded_bytes
+        started_wire_bytes = wire_bytes
+        rows_count = 0
         requests_count = 0
         # send request for each period
-        for request_url in requests_url:
+        skipped_count = 0
+        for request_url, period in zip(requests_url, requests_periods):
             requests_count += 1
+            request_key = ''
+            if archive:
+                request_key = get_archive_key(archive, table, request_url, period, json_allowed)
             logs(f'   Sending {requests_count} of {len(requests_url)}', 'info')
             if json_allowed:
                 # in json
-                json_text = get_json(session, request_url, request_timeout)
+                json_text = get_json(session, request_url, request_timeout, archive, request_key)
             else:
                 # in xml
-                json_text = get_json_from_xml(session, request_url, request_timeout)
+                json_text = get_json_from_xml(session, request_url, request_timeout, archive, request_key)
             if json_text:
+                rows_count += len(json_text.get('value', None) or [])
+                if by_period:
+                    payload_hash = get_payload_hash(request_url, json_text)
+                    if hashes.get(period) == payload_hash:
+                        skipped_count += 1
+                        logs('       Not changed since last load - skipped', 'info')
+                        continue
+                    # stored hash is removed before rows of period, new one is saved after successful write
+                    if not execute_query(**global_config, query=get_delete_hash_query(hash_table, table, period)):
+                        logs('       Cannot remove stored hash - period skipped', 'error')
+                        continue
+                    del_query = deleterows(table_name=table, date_field=date_field, date_from=period[0][:10],
+                                           date_to=period[1][:10], all=False)
+                    written = execute_query(**global_config, query=del_query)
+                else:
+                    written = True
                 # if ok - write to sql by portions
                 queries = get_insert_table_queries(table, json_text)
                 logs(f'       Queries to be sent to SQL: {len(queries)}', 'info')
@@ -464,17 +1072,42 @@ def run(yaml_file):
                 for each in queries:
                     queries_count += 1
                     logs(f'       Sending {queries_count} of {len(queries)}', 'info')
-                    execute_query(**global_config, query=each)
+                    if not execute_query(**global_config, query=each):
+                        written = False
+                if by_period and written:
+                    query = get_save_hash_query(hash_table, table, period, payload_hash)
+                    execute_query(**global_config, query=query)
+        if by_period:
+            logs(f'   Periods not changed: {skipped_count} of {len(requests_url)}', 'info')
+        if not (archive and archive['replay']):
+            table_stats = dict()
+            table_stats['requests'] = len(requests_url)
+            table_stats['rows'] = rows_count
+            table_stats['bytes'] = decoded_bytes - started_bytes
+            table_stats['wire_bytes'] = wire_bytes - started_wire_bytes
+            table_stats['seconds'] = (datetime.now() - started).total_seconds()
+            stats[table] = table_stats
     session.close()
+    if not (archive and archive['replay']):
+        save_stats(stats_file, stats)
+    logs(get_traffic_message(), 'info')
     logs(f'Done: {yaml_file}', 'info')
 
 
 verbose = False
+wire_bytes = 0
+decoded_bytes = 0
+traffic_lock = threading.Lock()
 today = str(date.today())
 logging.basicConfig(filename=f'{today}.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 mask = '*.yaml'
+# "python main.py plan" - only estimate the load, nothing is written
+mode = sys.argv[1].strip().lower() if len(sys.argv) > 1 else 'run'
 for yaml_file in glob.glob(mask):
     try:
-        run(yaml_file)
+        if mode == 'plan':
+            plan(yaml_file)
+        else:
+            run(yaml_file)
     except Exception as E:
         logs(f'{E} - cannot proceed {yaml_file}', 'error')
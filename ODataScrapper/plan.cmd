@@ -0,0 +1,7 @@
+@echo off
+echo Creating virtual environment for project
+call venv\Scripts\Activate.bat >> logenv.txt
+pip install -r requirements.txt > logenv.txt
+echo Ok. Running script...
+python main.py plan
+pause
\ No newline at end of file
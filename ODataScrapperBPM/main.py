@@ -1,5 +1,6 @@
 import requests
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
 import yaml
 import glob
@@ -7,6 +8,8 @@ import logging
 from datetime import date, datetime
 import pyodbc
 from time import sleep
+import gzip
+import zlib
 
 
 def logs(message, logtype='info'):
@@ -147,6 +150,50 @@ def get_json(xml):
     return res, meta
 
 
+def get_session(api_login, api_password, pool_size=10):
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(api_login, api_password)
+    # requests asks for gzip/deflate and keeps connections by default, pool is sized to parallel requests
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def decode_content(content, encoding):
+    # body of response read without decompression
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'gzip':
+        return gzip.decompress(content)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+def http_get(session, url, request_timeout=60):
+    global wire_bytes, decoded_bytes
+    # body is read without decompression to count bytes from the wire (raw.tell() misses chunked bodies)
+    response = session.get(url, timeout=request_timeout, stream=True)
+    raw_content = b''.join(response.raw.stream(64 * 1024, decode_content=False))
+    content = decode_content(raw_content, response.headers.get('Content-Encoding'))
+    response._content = content
+    response._content_consumed = True
+    wire_bytes += len(raw_content)
+    decoded_bytes += len(content)
+    return response
+
+
 def readnext(url, session, first, name, request_timeout=60):
     global global_config
     if url:
@@ -159,10 +206,10 @@ def readnext(url, session, first, name, request_timeout=60):
         else:
             sent_url = url
 
-        response = session.get(sent_url, timeout=request_timeout)
+        response = http_get(session, sent_url, request_timeout)
 
         if response.status_code == 400:
-            response = session.get(url, timeout=request_timeout)
+            response = http_get(session, url, request_timeout)
 
         if response.status_code == 200:
             xml_text = response.text
@@ -202,7 +249,11 @@ def readnext(url, session, first, name, request_timeout=60):
 def run(filename):
     global verbose
     global global_config
+    global wire_bytes, decoded_bytes
     logs(f'Starting with {filename}', 'info')
+    # traffic is reported for each yaml file
+    wire_bytes = 0
+    decoded_bytes = 0
     with open(filename, encoding='UTF-8') as json_file:
         settings = yaml.load(json_file, Loader=yaml.FullLoader)
     if not settings:
@@ -221,9 +272,7 @@ def run(filename):
     api_login = global_config['api_login']
     api_password = global_config['api_pwd']
 
-    auth = HTTPBasicAuth(api_login, api_password)
-    session = requests.Session()
-    session.auth = auth
+    session = get_session(api_login, api_password)
 
     tables = settings['tables']
     logs(f'found tables: {len(tables)}', 'info')
@@ -241,10 +290,13 @@ def run(filename):
 
         logs(f'Done {table}')
     session.close()
+    logs(f'Traffic: {format_bytes(wire_bytes)} on the wire, {format_bytes(decoded_bytes)} decoded', 'info')
     logs(f'Done: {filename}', 'info')
 
 
 verbose = False
+wire_bytes = 0
+decoded_bytes = 0
 today = str(date.today())
 logging.basicConfig(filename=f'{today}.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 mask = '*.yaml'